@@ -0,0 +1,100 @@
+import threading
+
+import numba
+import numpy as np
+from numba import njit, prange
+
+# --- 储能调度内核 (numba 编译) ---
+# 只接收 float64 / uint8 的 ndarray 和标量，不能出现 pandas 对象。
+# 放在独立模块里：Streamlit 每次交互都会重跑 mani.py，
+# 而这里的模块只导入一次，编译结果在整个进程内复用。
+
+# Streamlit 在工作线程里执行脚本：优先使用 OpenMP 线程层，
+# workqueue 不支持多线程同时启动并行内核，TBB 在非主线程调用后进程可能无法退出
+numba.config.THREADING_LAYER_PRIORITY = ["omp", "tbb", "workqueue"]
+_parallel_lock = threading.Lock()
+
+# --- 固定分时时段 (只依赖常量，进程内只计算一次) ---
+# 谷: 0-8点  峰: 12-14, 18-22点  平: 其他
+HOURS = np.arange(0, 24, 1)
+IS_VALLEY = HOURS < 8
+IS_PEAK = ((HOURS >= 12) & (HOURS < 14)) | ((HOURS >= 18) & (HOURS < 22))
+
+# 时段编码：每小时 1 字节，调度内核按编码分支，不比较浮点电价
+VALLEY, FLAT, PEAK = 0, 1, 2
+PERIOD = np.full(24, FLAT, dtype=np.uint8)
+PERIOD[IS_VALLEY] = VALLEY
+PERIOD[IS_PEAK] = PEAK
+
+# --- 演示用负荷曲线 (未上传 CSV 时使用，同样只计算一次) ---
+# 模拟一个带尖峰的工厂负载 (用于演示削峰)
+# 早上8点开工，中午休息，下午3点有个 250kW 的尖峰
+DEMO_LOAD = np.maximum(
+    100 + 50 * np.sin((HOURS - 8) / 3) ** 2 + 150 * np.exp(-((HOURS - 15) ** 2) / 4),
+    20,
+)
+
+
+def price_curve(price_peak, price_flat, price_valley):
+    # 24小时电价向量
+    return np.choose(PERIOD, [price_valley, price_flat, price_peak])
+
+
+# 显式签名：导入时即完成编译 (或直接从 __pycache__ 读取缓存)，
+# 第一次交互不再等待 LLVM 编译
+@njit("Tuple((f8[:], f8[:], f8, f8))(f8[:], f8[:], u1[:], f8, f8, f8, f8)", cache=True)
+def dispatch(load, price, period, threshold, batt_power, usable_cap, eff):
+    # 除逐小时结果外，在同一次遍历中累计 电网最大需量 和 日电度收益
+    n = load.shape[0]
+    batt = np.empty(n) # 电池功率 (+放 -充)
+    soc_trace = np.empty(n) # 每小时结束时的电量 (kWh)
+    soc = 0.0 # 初始电量
+    grid_max = -np.inf
+    elec_savings = 0.0
+
+    for i in range(n):
+        power = 0.0
+
+        # 策略优先级 1: 削峰 (Peak Shaving) - 必须动作
+        if load[i] > threshold:
+            # 受限于 需削减功率、额定功率 和 剩余电量
+            power = min(load[i] - threshold, batt_power, soc)
+            soc -= power
+
+        # 策略优先级 2: 套利 (Arbitrage) - 只在不需要削峰时考虑
+        elif period[i] == VALLEY:
+            # 谷价充电，不能超过容量限制
+            max_charge = min(batt_power, usable_cap - soc)
+            power = -max_charge
+            soc += max_charge * eff # 计入充电效率
+
+        elif period[i] == PEAK:
+            # 峰价放电
+            power = min(batt_power, soc)
+            soc -= power
+
+        batt[i] = power
+        soc_trace[i] = soc
+        grid_max = max(grid_max, load[i] - power)
+        elec_savings += power * price[i] # 放电收入 - 充电成本
+
+    return batt, soc_trace, grid_max, elec_savings
+
+
+@njit("Tuple((f8[:], f8[:]))(f8[:], f8[:], f8[:], u1[:], f8, f8, f8)", parallel=True, cache=True)
+def _sweep_thresholds(thresholds, load, price, period, batt_power, usable_cap, eff):
+    m = thresholds.shape[0]
+    grid_max = np.empty(m)
+    elec_savings = np.empty(m)
+    for k in prange(m):
+        _, _, grid_max[k], elec_savings[k] = dispatch(
+            load, price, period, thresholds[k], batt_power, usable_cap, eff)
+    return grid_max, elec_savings
+
+
+def sweep_thresholds(thresholds, load, price, period, batt_power, usable_cap, eff):
+    # 对一组削峰阈值分别做完整调度，各场景互不共享 SOC，可以并行
+    # 返回每个阈值下的 电网最大需量 和 日电度收益
+    # 多个会话同时点击时串行进入并行内核 (workqueue 线程层不是线程安全的)
+    with _parallel_lock:
+        return _sweep_thresholds(thresholds, load, price, period, batt_power, usable_cap, eff)
@@ -2,7 +2,18 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
-import numpy_financial as npf
+
+# 可选：安装了 polars 时用它解析上传的 CSV (多线程 Arrow 解析器)
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+
+from dispatch import DEMO_LOAD, HOURS, PERIOD, dispatch, price_curve, sweep_thresholds
+
+# 年化假设 (阈值扫描和收益分析共用)
+OPERATING_DAYS = 330 # 假设每年运行330天
+PROJECT_YEARS = 10 # IRR 计算期 (年)
 
 # --- 1. 页面配置 ---
 st.set_page_config(page_title="工商业储能 ROI (含需量)", layout="wide")
@@ -41,193 +52,215 @@ with st.sidebar.expander("3. 需量电价 (基本电费)", expanded=True):
 st.subheader("📊 负荷曲线分析")
 uploaded_file = st.file_uploader("上传负荷 CSV (选填)", type=["csv"])
 
-hours = np.arange(0, 24, 1)
-
 if uploaded_file:
     try:
-        df = pd.read_csv(uploaded_file)
-        # 假设第一列是时间，第二列是功率，这里做简单处理
-        load_curve = df.iloc[:, 1].values[:24] 
+        # 假设第一列是时间，第二列是功率，只读取功率列的前24行
+        if pl is not None:
+            load_curve = pl.read_csv(uploaded_file, columns=[1], n_rows=24).to_numpy().ravel()
+        else:
+            load_curve = pd.read_csv(uploaded_file, usecols=[1], nrows=24).to_numpy().ravel()
         st.success("已加载自定义负荷数据")
     except:
         st.error("CSV格式有误，使用模拟数据")
         load_curve = np.array([50]*24)
 else:
-    # 模拟一个带尖峰的工厂负载 (用于演示削峰)
-    # 早上8点开工，中午休息，下午有个大尖峰
-    base_load = 100
-    load_curve = base_load + \
-                 50 * np.sin((hours - 8)/3)**2 + \
-                 150 * np.exp(-((hours - 15)**2)/4) # 下午3点有个 250kW 的尖峰
-    load_curve = np.maximum(load_curve, 20)
+    # 模拟工厂负载 (在 dispatch 模块中预先生成)
+    load_curve = DEMO_LOAD
 
 # 获取原始最大需量
 original_max_demand = np.max(load_curve)
 
 # 3.2 设定削峰目标 (阈值)
+
+# 在 0 ~ 原始最大需量 之间扫描阈值，取年化总收益最高的一个
+@st.cache_data
+def find_optimal_threshold(load_curve, price_peak, price_flat, price_valley,
+                           batt_power, batt_capacity, eff, dod, demand_price, n_points=50):
+    # 必须复制成可写数组：polars / pandas 读出的数组可能是只读的，与内核的显式签名不匹配
+    load_arr = np.array(load_curve, dtype=np.float64)
+    thresholds = np.linspace(0.0, load_arr.max(), n_points)
+    grid_max, elec_savings = sweep_thresholds(
+        thresholds, load_arr, price_curve(price_peak, price_flat, price_valley),
+        PERIOD, float(batt_power), float(batt_capacity * dod), float(eff))
+    annual_savings = (load_arr.max() - grid_max) * demand_price * 12 + elec_savings * OPERATING_DAYS
+    return float(thresholds[np.argmax(annual_savings)])
+
 col_a, col_b = st.columns([1, 2])
 with col_a:
     st.metric("原始最大需量", f"{original_max_demand:.1f} kW")
+    auto_threshold = st.toggle("🎯 自动寻找最优阈值", help="扫描 50 个阈值，选择年化总收益最高的一个")
 with col_b:
-    # 默认削减到原本的 80% 或者 电池功率能覆盖的范围
-    default_threshold = max(0, original_max_demand - batt_power * 0.8)
+    if auto_threshold:
+        default_threshold = find_optimal_threshold(load_curve, price_peak, price_flat, price_valley,
+                                                   batt_power, batt_capacity, eff, dod, demand_price)
+    else:
+        # 默认削减到原本的 80% 或者 电池功率能覆盖的范围
+        default_threshold = max(0, original_max_demand - batt_power * 0.8)
     threshold = st.slider("📉 设定目标需量 (削峰阈值 kW)", 
                           min_value=0.0, 
                           max_value=float(original_max_demand), 
                           value=float(default_threshold),
+                          disabled=auto_threshold,
                           help="系统将尝试通过放电，把电网取电限制在这个值以下")
 
 # --- 4. 核心算法：削峰 + 套利 ---
 
-# 初始化
-sim_data = pd.DataFrame(index=hours)
-sim_data['Hour'] = hours
-sim_data['Load'] = load_curve
-sim_data['Threshold'] = threshold
-
-# 电价函数
-def get_price(h):
-    if 0 <= h < 8: return price_valley
-    elif (12 <= h < 14) or (18 <= h < 22): return price_peak
-    else: return price_flat
-
-sim_data['Price'] = sim_data['Hour'].apply(get_price)
-
-# 逐小时模拟
-soc = 0.0 # 初始电量
-usable_cap = batt_capacity * dod
-batt_actions = [] # 电池功率 (+放 -充)
-
-for i in range(24):
-    h = sim_data.iloc[i]['Hour']
-    load = sim_data.iloc[i]['Load']
-    price = sim_data.iloc[i]['Price']
-    
-    power = 0.0
-    
-    # ------------------------------------------------
-    # 策略优先级 1: 削峰 (Peak Shaving) - 必须动作
-    # ------------------------------------------------
-    if load > threshold:
-        # 需要削减的功率
-        needed_shave = load - threshold
-        # 电池能提供的最大功率 (受限于额定功率 和 剩余电量)
-        max_discharge_by_soc = soc 
-        actual_shave = min(needed_shave, batt_power, max_discharge_by_soc)
-        
-        power = actual_shave # 正数为放电
-        soc -= actual_shave # 扣减电量
-        
-    # ------------------------------------------------
-    # 策略优先级 2: 套利 (Arbitrage) - 可选动作
-    # 只有在不需要削峰的时候，才考虑价格套利
-    # ------------------------------------------------
-    else:
-        # 谷价 -> 充电
-        if price == price_valley:
-            # 尽可能充，但不能超过容量限制
-            max_charge = min(batt_power, usable_cap - soc)
-            power = -max_charge # 负数为充电
-            soc += max_charge * eff # 计入充电效率
-            
-        # 峰价 -> 放电 (但要保留一部分电量给未来的削峰吗？)
-        # 简化逻辑：如果是峰价，且不需要削峰，就放电赚钱
-        # (高级逻辑需要预测未来负载，这里做简化处理)
-        elif price == price_peak:
-            # 尽可能放
-            max_discharge = min(batt_power, soc)
-            power = max_discharge
-            soc -= max_discharge
-            
-        else:
-            power = 0 # 平价待机
-
-    batt_actions.append(power)
-
-sim_data['Battery_kW'] = batt_actions
-# 计算实际电网取电 = 负载 - 电池放电 (如果是充电，则是 负载 - (-充电) = 负载 + 充电)
-sim_data['Grid_kW'] = sim_data['Load'] - sim_data['Battery_kW'] 
+# 只依赖这些输入：需量电价等只影响财务计算的参数变化时，直接命中缓存
+@st.cache_data
+def simulate(load_curve, price_peak, price_flat, price_valley,
+             batt_power, batt_capacity, eff, dod, threshold):
+    # 分时电价 (时段编码在 dispatch 模块中预先算好)
+    price_arr = price_curve(price_peak, price_flat, price_valley)
+
+    # 逐小时模拟 (SOC 前后依赖，交给 numba 编译的调度内核顺序计算)
+    usable_cap = batt_capacity * dod
+    # 必须复制成可写数组：polars / pandas 读出的数组可能是只读的，与内核的显式签名不匹配
+    load_arr = np.array(load_curve, dtype=np.float64)
+    batt, soc_trace, grid_max, daily_elec_savings = dispatch(
+        load_arr, price_arr, PERIOD,
+        float(threshold), float(batt_power), float(usable_cap), float(eff))
+
+    # 财务计算直接用内核累计的结果，下面的表只用于展示；所有列一次性构建
+    sim_data = pd.DataFrame({
+        'Hour': HOURS,
+        'Load': load_arr,
+        'Threshold': threshold,
+        'Price': price_arr,
+        'Battery_kW': batt,
+        'SOC_kWh': soc_trace,
+        # 实际电网取电 = 负载 - 电池放电 (如果是充电，则是 负载 - (-充电) = 负载 + 充电)
+        'Grid_kW': load_arr - batt,
+        # 电度收益 = 放电收入 - 充电成本
+        'Elec_Cost_Savings': batt * price_arr,
+    }, index=HOURS)
+    return sim_data, grid_max, daily_elec_savings
+
+sim_data, new_max_demand, daily_elec_savings = simulate(
+    load_curve, price_peak, price_flat, price_valley,
+    batt_power, batt_capacity, eff, dod, threshold)
 
 # --- 5. 财务计算 ---
 
 # 5.1 需量收益计算
-new_max_demand = sim_data['Grid_kW'].max()
 demand_reduction = original_max_demand - new_max_demand
 # 每月节省 = 削减的功率 * 单价
 monthly_demand_savings = demand_reduction * demand_price
 annual_demand_savings = monthly_demand_savings * 12
 
 # 5.2 电度收益计算 (套利)
-# 收益 = 放电收入 - 充电成本
-sim_data['Elec_Cost_Savings'] = sim_data.apply(
-    lambda x: (x['Battery_kW'] * x['Price']), axis=1
-)
-daily_elec_savings = sim_data['Elec_Cost_Savings'].sum()
-annual_elec_savings = daily_elec_savings * 330 # 假设运行330天
+annual_elec_savings = daily_elec_savings * OPERATING_DAYS
 
 # 5.3 总收益
 total_annual_savings = annual_demand_savings + annual_elec_savings
 payback = capex / total_annual_savings if total_annual_savings > 0 else 99
 
+# 5.4 内部收益率
+# 现金流是 1 笔投资 + N 笔等额收益，IRR 满足 capex = pmt * (1 - (1+r)^-N) / r，
+# 直接用牛顿法解这个年金方程，不需要对一般多项式求根
+def annuity_irr(capex, pmt, n):
+    r = pmt / capex # 永续年金收益率，一定不小于真实 IRR
+    for _ in range(100):
+        if abs(r) < 1e-12:
+            break
+        v = (1 + r) ** -n
+        f = pmt * (1 - v) / r - capex
+        df = pmt * (n * v / (1 + r) * r - (1 - v)) / r**2
+        step = f / df
+        # 牛顿步越过 -100% 时退回到中点
+        r = r - step if r - step > -1 else (r - 1) / 2
+        if abs(step) < 1e-12:
+            break
+    return r
+
+# 投资为 0 或收益不为正时 IRR 没有意义，显示 "—"
+irr = (annuity_irr(capex, total_annual_savings, PROJECT_YEARS) * 100
+       if capex > 0 and total_annual_savings > 0 else None)
+
 # --- 6. 结果展示 ---
 
 st.subheader("💰 收益分析")
 
-# 指标卡片
-c1, c2, c3, c4 = st.columns(4)
-c1.metric("1. 需量电费节省 (年)", f"¥ {annual_demand_savings:,.0f}", 
-          delta=f"需量降低 {demand_reduction:.1f} kW")
-c2.metric("2. 峰谷套利收益 (年)", f"¥ {annual_elec_savings:,.0f}")
-c3.metric("🔥 总年化收益", f"¥ {total_annual_savings:,.0f}")
-c4.metric("静态回收期", f"{payback:.2f} 年", delta_color="inverse")
-
-# 可视化图表
-fig = go.Figure()
-
-# 1. 原始负荷 (灰色填充)
-fig.add_trace(go.Scatter(
-    x=sim_data['Hour'], y=sim_data['Load'],
-    name='原始负荷',
-    fill='tozeroy', line=dict(color='gray', width=0), opacity=0.2
-))
-
-# 2. 削峰后电网负荷 (粗线)
-fig.add_trace(go.Scatter(
-    x=sim_data['Hour'], y=sim_data['Grid_kW'],
-    name='削峰后电网取电',
-    line=dict(color='#2563eb', width=3)
-))
-
-# 3. 需量红线 (虚线)
-fig.add_trace(go.Scatter(
-    x=[0, 23], y=[threshold, threshold],
-    name=f'目标需量 ({threshold:.0f}kW)',
-    line=dict(color='red', dash='dash', width=2)
-))
-
-# 4. 电池动作 (柱状图)
-fig.add_trace(go.Bar(
-    x=sim_data['Hour'], y=sim_data['Battery_kW'],
-    name='电池动作 (+放 -充)',
-    marker_color=sim_data['Battery_kW'].apply(lambda x: '#ef4444' if x > 0 else '#10b981'),
-    opacity=0.8,
-    yaxis='y2'
-))
-
-fig.update_layout(
-    title="削峰填谷策略模拟 (24小时)",
-    xaxis_title="时间 (小时)",
-    yaxis=dict(title="功率 (kW)", side="left"),
-    yaxis2=dict(title="电池功率", side="right", overlaying="y", showgrid=False),
-    legend=dict(orientation="h", y=1.1),
-    hovermode="x unified"
+# 指标卡片 (一次 st.markdown 输出，代替 columns + 多个 metric 组件)
+# 需量反而上升 (例如谷时充电抬高了电网峰值) 时改用红色向下箭头提示
+demand_delta = (f"<small style='color:#10b981'>↑ 需量降低 {demand_reduction:.1f} kW</small>"
+                if demand_reduction >= 0 else
+                f"<small style='color:#ef4444'>↓ 需量上升 {-demand_reduction:.1f} kW</small>")
+kpis = [
+    ("1. 需量电费节省 (年)", f"¥ {annual_demand_savings:,.0f}", demand_delta),
+    ("2. 峰谷套利收益 (年)", f"¥ {annual_elec_savings:,.0f}", ""),
+    ("🔥 总年化收益", f"¥ {total_annual_savings:,.0f}", ""),
+    ("静态回收期", f"{payback:.2f} 年", ""),
+    (f"{PROJECT_YEARS}年 IRR", f"{irr:.1f} %" if irr is not None else "—", ""),
+]
+st.markdown(
+    "<div style='display:flex;gap:2rem;flex-wrap:wrap'>" + "".join(
+        f"<div style='flex:1'><small>{label}</small>"
+        f"<div style='font-size:2rem'>{value}</div>"
+        f"{delta}</div>"
+        for label, value, delta in kpis
+    ) + "</div>",
+    unsafe_allow_html=True
 )
 
+# 可视化图表 (只依赖模拟结果和阈值)
+# 用 cache_resource 直接复用同一个 Figure 对象：cache_data 每次命中都要反序列化并重新校验整个图，
+# 而 st.plotly_chart 只读取图，不会修改它。限制条目数，避免每个滑块位置的图都常驻内存
+@st.cache_resource(max_entries=64)
+def build_figure(sim_data, threshold):
+    # 先把用到的列取成 ndarray，后面只做数组访问
+    hour = sim_data['Hour'].to_numpy()
+    batt = sim_data['Battery_kW'].to_numpy()
+
+    # 所有曲线和布局一次性传入，避免逐条 add_trace 反复校验
+    return go.Figure(
+        data=[
+            # 1. 原始负荷 (灰色填充)
+            go.Scatter(
+                x=hour, y=sim_data['Load'].to_numpy(),
+                name='原始负荷',
+                fill='tozeroy', line=dict(color='gray', width=0), opacity=0.2
+            ),
+            # 2. 削峰后电网负荷 (粗线)
+            go.Scatter(
+                x=hour, y=sim_data['Grid_kW'].to_numpy(),
+                name='削峰后电网取电',
+                line=dict(color='#2563eb', width=3)
+            ),
+            # 3. 需量红线 (虚线)
+            go.Scatter(
+                x=[0, 23], y=[threshold, threshold],
+                name=f'目标需量 ({threshold:.0f}kW)',
+                line=dict(color='red', dash='dash', width=2)
+            ),
+            # 4. 电池动作 (柱状图)
+            go.Bar(
+                x=hour, y=batt,
+                name='电池动作 (+放 -充)',
+                marker_color=np.where(batt > 0, '#ef4444', '#10b981'),
+                opacity=0.8,
+                yaxis='y2'
+            ),
+        ],
+        layout=dict(
+            title="削峰填谷策略模拟 (24小时)",
+            xaxis_title="时间 (小时)",
+            yaxis=dict(title="功率 (kW)", side="left"),
+            yaxis2=dict(title="电池功率", side="right", overlaying="y", showgrid=False),
+            legend=dict(orientation="h", y=1.1),
+            hovermode="x unified"
+        ),
+    )
+
+fig = build_figure(sim_data, threshold)
 st.plotly_chart(fig, use_container_width=True)
 
 # 底部数据表
 with st.expander("查看详细数据表"):
-    st.dataframe(sim_data.style.format("{:.2f}").background_gradient(subset=['Battery_kW'], cmap='RdYlGn_r'))
+    # 用原生列配置格式化 (浏览器端渲染)，不再生成 Styler HTML
+    st.dataframe(sim_data, column_config={
+        col: st.column_config.NumberColumn(format="%.2f")
+        for col in sim_data.columns if col != 'Hour'
+    })
 
 # 营销钩子
 st.sidebar.markdown("---")